@@ -2,11 +2,19 @@
 """ Reencodes flac files recursively from the specified directory, overwriting the old files """
 
 import argparse
+import functools
+import hashlib
+import json
 import os
+import select
 import shlex
+import shutil
+import struct
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from packaging import version
 
@@ -18,8 +26,15 @@ if __name__ == "__main__" and __package__ is None:
 
 from shared.utils import print_progress
 
+_FLAC_EXTENSIONS = frozenset(["flac", "fla"])
+_HEADER_READ_SIZE = 65536
+_unpack_uint32_be = struct.Struct('>I').unpack_from
+_unpack_uint32_le = struct.Struct('<I').unpack_from
+_thread_data = threading.local()
 
-def reencode_flac(lib_path: str, min_version: str = None, force: bool = False, n_procs: int = 4, verbose: bool = False) -> int:
+
+def reencode_flac(lib_path: str, min_version: str = None, force: bool = False, n_procs: int = 4, verbose: bool = False,
+                  use_cache: bool = False) -> int:
     """ Reencodes flac files recursively from the specified directory, overwriting the old files
     :param lib_path: Base directory from which files will reencoded recursively
     :param min_version: Files encoded with a version of FLAC below min_version will be reencoded.
@@ -27,6 +42,7 @@ def reencode_flac(lib_path: str, min_version: str = None, force: bool = False, n
     :param force: If True, reencodes all files no matter what FLAC version they were previously encoded with.
     :param n_procs: Number of encoding tasks to run concurrently
     :param verbose: If True, additional subprocess output is displayed
+    :param use_cache: If True, encoder versions are cached between runs and only read again from modified files
     :return: 0 if the process ran successfully
     """
 
@@ -39,8 +55,12 @@ def reencode_flac(lib_path: str, min_version: str = None, force: bool = False, n
         print("n_procs should be >= 1, value reset to default {}".format(n_procs))
 
     # Check if flac is in the PATH variable and get the version
+    # The executable is resolved once so that neither a shell nor a PATH lookup is needed for each file
+    flac_bin = shutil.which("flac")
     try:
-        flac_version = subprocess.check_output("flac -v", shell=True).decode('utf-8').split()[-1]
+        if flac_bin is None:
+            raise FileNotFoundError("flac executable not found")
+        flac_version = subprocess.check_output([flac_bin, "-v"]).decode('utf-8').split()[-1]
         flac_version = version.parse(flac_version)
         print("Flac version " + str(flac_version) + " found.")
     except version.InvalidVersion:
@@ -68,45 +88,55 @@ def reencode_flac(lib_path: str, min_version: str = None, force: bool = False, n
             print("Minimum version set to {}.".format(min_version))
 
     # Extracts the FLAC files from the file system and output number of files and total size
-    flac_files = []
-    dir_count = 1  # Start at 1 for the base directory
-
-    for root, dirs, files in os.walk(lib_path):
-        flac_files += [os.path.join(root, file) for file in files if is_flac(file)]
-        dir_count += len(dirs)
-    print(len(flac_files), " FLAC files found in ", dir_count, " directories")
-
-    # Select the flac files that need to be reencoded
-    if not force:
-        flac_files = [file for file in flac_files if _needs_reencoding(file, min_version)]
+    # Files are streamed as (path, size) tuples to reuse the size cached by os.scandir
+    counts = {'dirs': 0, 'files': 0}
+    found_msg = "{} FLAC files found in {} directories"
+    flac_files = _scan_flac_files(lib_path, counts)
+    if force:
+        flac_files = list(flac_files)
+        print(found_msg.format(counts['files'], counts['dirs']))
+    else:
+        # Select the flac files that need to be reencoded
+        # Reading the file headers is I/O bound, so it is done in parallel threads while the scan is consumed
+        cache = _load_cache(lib_path) if use_cache else None
+        new_cache = dict() if use_cache else None
+        with ThreadPoolExecutor(max_workers=min(32, n_procs*4)) as executor:
+            selected = executor.map(lambda file: file if _needs_reencoding(file[0], min_version, cache, new_cache)
+                                    else None, flac_files)
+            print(found_msg.format(counts['files'], counts['dirs']))
+            flac_files = [file for file in selected if file]
+        if use_cache:
+            _save_cache(lib_path, new_cache)
         print(len(flac_files), " FLAC files need reencoding. (Use the -f force flag to reencode all files)")
 
-    file_size = int(sum(os.path.getsize(file) for file in flac_files)/(1000**2))
+    file_size = int(sum(size for _, size in flac_files)/(1000**2))
     print("Size of files is ", file_size, " MB")
 
-    # Calls encoding tasks in parallel
-    processes = set()
-    flac_command = shlex.split('flac --best --verify --force --decode-through-errors')
+    # Calls encoding tasks in parallel, each slot holds a running process or None if it is free
+    slots = [None] * n_procs
+    flac_command = (flac_bin,) + tuple(shlex.split('--best --verify --force --decode-through-errors'))
     errors = []
     current_file = 0
     msg = "Encoding file {}/{}"
     output = None if verbose else subprocess.DEVNULL
-    for file in flac_files:
+    for file, _ in flac_files:
         current_file += 1
         print_progress(msg, current_file, len(flac_files))
-        processes.add(subprocess.Popen(flac_command + [file], stdout=output, stderr=output))
-        while len(processes) >= n_procs:
-            _wait_for_processes(processes, errors)
+        while None not in slots:
+            _wait_for_processes(slots, errors)
+        # Python creates file descriptors as non-inheritable, so there is nothing to close in the child
+        slots[slots.index(None)] = subprocess.Popen(flac_command + (file,), stdout=output, stderr=output,
+                                                    close_fds=False)
 
     # Wait for the remaining processes to finish
-    while len(processes) > 0:
-        _wait_for_processes(processes, errors)
+    while any(slots):
+        _wait_for_processes(slots, errors)
 
     print_progress(msg, current_file, len(flac_files), final=True)
     print("Encoding completed!")
 
     # Check how much space was saved and show errors if any
-    new_file_size = int(sum(os.path.getsize(file) for file in flac_files)/(1000**2))
+    new_file_size = int(sum(os.path.getsize(file) for file, _ in flac_files)/(1000**2))
     print("\nNew size of files is ", new_file_size, " MB")
     print(file_size - new_file_size, " MB saved!")
 
@@ -117,59 +147,128 @@ def reencode_flac(lib_path: str, min_version: str = None, force: bool = False, n
     return 0
 
 
-def get_flac_vendor_string(file: str) -> str:
-    """ Attempts to read the vendor string from a flac file
+def get_flac_vendor_bytes(file: str) -> bytes:
+    """ Attempts to read the raw vendor string from a flac file, without decoding it
         reference https://xiph.org/flac/format.html#stream
     """
 
-    with open(file, "rb") as f:
-        # Init
-        result = ""
-        block_type = 0
+    with open(file, "rb", buffering=0) as f:
+        # Only the header is needed, the kernel is asked to fetch just that range where supported.
+        # Some file systems reject the hint, the file is then read normally.
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(f.fileno(), 0, _HEADER_READ_SIZE, os.POSIX_FADV_WILLNEED)
+            except OSError:
+                pass
+
+        # The metadata blocks usually fit in the first read, the file is only read again past large blocks
+        # The read buffer is reused by each thread, only the first data_len bytes are valid
+        data = getattr(_thread_data, 'header_buffer', None)
+        if data is None:
+            data = _thread_data.header_buffer = bytearray(_HEADER_READ_SIZE)
+        data_len = f.readinto(data)
+        data_pos = 0  # Position of data in the file
+        offset = 4  # Position of the current block header in data
 
         # Read the flac identifier
-        data = f.read(4).decode('utf-8', errors="ignore")
-        if data != "fLaC":
+        if data_len < 4 or not data.startswith(b"fLaC"):
             raise TypeError("File does not comply to flac format: {}".format(file))
 
         # Search the metadata blocks for the first vorbis_comment block
-        # A type of more than 126 means its either invalid or the last metadata block
-        while data and block_type < 126:
-            data = f.read(4)
-            block_type = int.from_bytes([data[0]], byteorder='big')
-            block_length = int.from_bytes(data[1:], byteorder='big')
+        while True:
+            if offset + 8 > data_len:
+                f.seek(data_pos + offset)
+                data_pos += offset
+                offset = 0
+                data_len = f.readinto(data)
+                if data_len < 4:
+                    return b""
+
+            # The header is 1 bit flagging the last metadata block, 7 bits of block type and 24 bits of block length
+            header, = _unpack_uint32_be(data, offset)
+            block_type = (header >> 24) & 0x7F
+            block_length = header & 0xFFFFFF
 
             # Read the string from the vorbis_comment data block (type 4)
             # https://www.xiph.org/vorbis/doc/v-comment.html
             if block_type == 4:
                 # The vendor string is the first field in the block
-                field_length = int.from_bytes(f.read(4), byteorder='little')
-                data = f.read(field_length)
-                result = data.decode('utf-8', errors="ignore")
-                break
-            else:
-                f.seek(block_length, 1)
-        
-        return result
+                if offset + 8 > data_len:
+                    return b""
+                field_length, = _unpack_uint32_le(data, offset + 4)
+                field_start = offset + 8
+                if field_start + field_length <= data_len:
+                    with memoryview(data) as view:
+                        vendor = bytes(view[field_start:field_start + field_length])
+                else:
+                    f.seek(data_pos + field_start)
+                    vendor = f.read(field_length)
+                return vendor
+
+            # A type of 127 is invalid
+            if header >> 31 or block_type == 127:
+                return b""
+            offset += 4 + block_length
+
+
+def get_flac_vendor_string(file: str) -> str:
+    """ Attempts to read the vendor string from a flac file """
+    return get_flac_vendor_bytes(file).decode('utf-8', errors="ignore")
 
 
 def is_flac(file: str) -> bool:
     """ Checks the extension of a file name to see if it's a FLAC file """
-    ext = (file.split(".")[-1]).lower()
-    return ext == 'flac' or ext == 'fla'
+    return file.rpartition(".")[2].lower() in _FLAC_EXTENSIONS
+
+
+def _cache_path(lib_path):
+    """ Returns the path of the encoder version cache file for a library """
+    lib_hash = hashlib.sha1(os.path.abspath(lib_path).encode('utf-8')).hexdigest()
+    return os.path.join(os.path.expanduser("~"), ".cache", "media-library-helper",
+                        "reencode_flac_versions_" + lib_hash + ".json")
+
+
+def _get_encoder_version(file, cache=None, new_cache=None):
+    """ Returns the libFLAC version found in the vendor string of a file, or an empty string if the file was not
+        encoded with the reference encoder. The cached version is used if the file was not modified since.
+        flac keeps the modification time of reencoded files, so the inode and status change time are also compared.
+    :param cache: Dictionary of {path: [mtime_ns, size, inode, ctime_ns, encoder_version]} from the previous run.
+                  Ignored if None.
+    :param new_cache: Dictionary in which the entry of the file is stored for the next run. Ignored if None.
+    """
+    if cache is None:
+        return _parse_encoder_version(get_flac_vendor_bytes(file))
+
+    stat = os.stat(file)
+    key = [stat.st_mtime_ns, stat.st_size, stat.st_ino, stat.st_ctime_ns]
+    entry = cache.get(file)
+    if not (entry and entry[:4] == key):
+        entry = key + [_parse_encoder_version(get_flac_vendor_bytes(file))]
+    if new_cache is not None:
+        new_cache[file] = entry
+    return entry[4]
 
 
-def _needs_reencoding(file: str, flac_version: version.Version) -> bool:
+def _load_cache(lib_path):
+    """ Loads the encoder version cache of a library, returns an empty cache if it doesn't exist or can't be read """
+    try:
+        with open(_cache_path(lib_path), "r", encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _needs_reencoding(file: str, flac_version: version.Version, cache: dict = None, new_cache: dict = None) -> bool:
     """ Check if the file was encoded with an older version of FLAC """
     try:
-        vendor_string = get_flac_vendor_string(file).split()
+        encoder_version = _get_encoder_version(file, cache, new_cache)
     except Exception as e:
         print("File skipped: " + str(e))
         return False
 
-    if len(vendor_string) >= 3 and vendor_string[0] == "reference" and vendor_string[1] == "libFLAC":
+    if encoder_version:
         try:
-            if version.parse(vendor_string[2]) < flac_version:
+            if _parse_version(encoder_version) < flac_version:
                 return True
             else:
                 return False
@@ -179,14 +278,76 @@ def _needs_reencoding(file: str, flac_version: version.Version) -> bool:
         return True
 
 
-def _wait_for_processes(processes, errors):
-    """ Wait for processes to complete and updates the running process list and error list """
-    time.sleep(.5)
-    completed = [p for p in processes if p.poll() is not None]
-    processes.difference_update(completed)
-    for p in completed:
-        if p.returncode != 0:
-            errors += [[p.returncode, p.args]]
+def _parse_encoder_version(vendor):
+    """ Returns the version from a raw vendor string of the reference encoder, or an empty string for other encoders
+        Only the version is decoded, the rest of the vendor string is compared as bytes
+    """
+    vendor = vendor.split()
+    if len(vendor) >= 3 and vendor[0] == b"reference" and vendor[1] == b"libFLAC":
+        return vendor[2].decode('ascii', errors="ignore")
+    return ""
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_version(version_string):
+    """ Parses a version string, cached as most files of a library share the same few encoder versions """
+    return version.parse(version_string)
+
+
+def _save_cache(lib_path, cache):
+    """ Saves the encoder version cache of a library """
+    cache_path = _cache_path(lib_path)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w", encoding='utf-8') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print("Could not save the encoder version cache: " + str(e))
+
+
+def _scan_flac_files(lib_path, counts):
+    """ Yields a (path, size) tuple for each FLAC file found recursively from lib_path
+        As with os.walk, symbolic links to directories are not followed and unreadable directories are skipped.
+    :param counts: Dictionary in which the number of scanned directories ('dirs') and found files ('files') are added
+    """
+    dirs = [lib_path]
+    while dirs:
+        try:
+            entries = os.scandir(dirs.pop())
+        except OSError:
+            continue
+        counts['dirs'] += 1
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file() and is_flac(entry.name):
+                    counts['files'] += 1
+                    yield entry.path, entry.stat().st_size
+
+
+def _wait_for_processes(slots, errors):
+    """ Wait for processes to complete, frees their slot and updates the error list """
+    # On Linux, block until one of our processes exits, using a pidfd per process. Only our own children are waited
+    # on, so exit statuses of other subprocesses of the caller are left alone. Elsewhere, poll periodically.
+    pidfds = []
+    try:
+        for p in slots:
+            if p is not None:
+                pidfds += [os.pidfd_open(p.pid)]
+        if pidfds:
+            select.select(pidfds, [], [])
+    except (AttributeError, OSError):
+        time.sleep(.5)
+    finally:
+        for fd in pidfds:
+            os.close(fd)
+
+    for i, p in enumerate(slots):
+        if p is not None and p.poll() is not None:
+            slots[i] = None
+            if p.returncode != 0:
+                errors += [[p.returncode, p.args]]
 
 
 if __name__ == '__main__':
@@ -196,5 +357,8 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--force', action='store_true', help='Forces reencoding all files no matter what FLAC version they were previously encoded with.')
     parser.add_argument('-n', '--n_procs', type=int, default=4, help='Number of files to encode in parallel.')
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-c', '--cache', dest='use_cache', action='store_true',
+                        help='Cache the encoder version of the files in ~/.cache/media-library-helper, so unmodified '
+                             'files are not read again on the next runs.')
     args = parser.parse_args()
     sys.exit(reencode_flac(**vars(args)))
@@ -30,6 +30,7 @@ diff_names = fs3.subtract_names(fs2)  # Removes all fs3 files match fs2 filename
 """
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 
 class FileSet:
@@ -40,6 +41,8 @@ class FileSet:
         self.rootdirs = rootdirs
         self.rel_paths = rel_paths
         self.lower = lower
+        self._lower_paths = None  # List of (lowercase path, path) tuples, built on first use by find()
+        self._name_indexes = dict()  # {lower: {file name: [paths]}}, built on first use by find()
 
     @classmethod
     def build(cls, root_dirs, rel_paths=False, lower=False):
@@ -60,20 +63,14 @@ class FileSet:
         paths = set()
         names = set()
 
-        for root in root_dirs:
-            for (dirpath, dirnames, filenames) in os.walk(root):
-                path = os.path.relpath(dirpath, root) if rel_paths else dirpath
-                path = path[1:] if path.startswith(".") else path  # Happens at the root directory
-
-                if lower:
-                    path = path.lower()
-                    for filename in filenames:
-                        names.add(filename.lower())
-                        paths.add(os.path.join(path, filename).lower())
-                else:
-                    for filename in filenames:
-                        names.add(filename)
-                        paths.add(os.path.join(path, filename))
+        # Scanning is I/O bound, so several root directories are scanned in parallel threads
+        if len(root_dirs) == 1:
+            paths, names = _scan_root(next(iter(root_dirs)), rel_paths, lower)
+        elif root_dirs:
+            with ThreadPoolExecutor(max_workers=min(8, len(root_dirs))) as executor:
+                for root_paths, root_names in executor.map(lambda root: _scan_root(root, rel_paths, lower), root_dirs):
+                    paths |= root_paths
+                    names |= root_names
 
         return cls(paths, names, root_dirs, rel_paths, lower)
 
@@ -87,41 +84,38 @@ class FileSet:
         if self.rel_paths and not other.rel_paths:
             raise ValueError("Left operand cannot have relative paths if right operand does not.")
         elif not self.rel_paths and other.rel_paths:
-            paths = []
+            # Names are collected in the same pass as the paths
+            paths = set()
+            names = set()
+            depths = _get_depths(other.paths)
             for i in self.paths:
-                included = True
-                for j in other.paths:
-                    if j in i:
-                        included = False
-                        break
-                if included:
-                    paths += [i]
-            paths = set(paths)
+                if not _ends_with_any(i, other.paths, depths):
+                    paths.add(i)
+                    names.add(_basename(i))
         else:
             paths = self.paths - other.paths
+            names = {_basename(i) for i in paths}
 
-        names = set([os.path.basename(i) for i in paths])
         return FileSet(paths, names, self.rootdirs, self.rel_paths, self.lower)
 
     def __and__(self, other):
         if self.rel_paths ^ other.rel_paths:
+            # Full paths are iterated and their suffixes probed in the relative paths, so the sides can't be swapped
             first_set = other.paths if self.rel_paths else self.paths
             second_set = self.paths if self.rel_paths else other.paths
 
-            paths = []
+            # Names are collected in the same pass as the paths
+            paths = set()
+            names = set()
+            depths = _get_depths(second_set)
             for i in first_set:
-                included = False
-                for j in second_set:
-                    if j in i:
-                        included = True
-                        break
-                if included:
-                    paths += [i]
-            paths = set(paths)
+                if _ends_with_any(i, second_set, depths):
+                    paths.add(i)
+                    names.add(_basename(i))
         else:
             paths = self.paths & other.paths
+            names = {_basename(i) for i in paths}
 
-        names = set([os.path.basename(i) for i in paths])
         return FileSet(paths, names, self.rootdirs, self.rel_paths, self.lower)
 
     def __or__(self, other):
@@ -134,7 +128,10 @@ class FileSet:
         return FileSet(paths, names, self.rootdirs | other.rootdirs, self.rel_paths, self.lower)
 
     def find(self, names, disp=True, lower=True):
-        """ Finds the paths where one or more files are located
+        """ Finds the paths where one or more files are located.
+            A bare file name, without any directory separator, matches files with exactly that name, e.g. "a.jpg"
+            matches "dir/a.jpg" but not "dir/data.jpg". A name including directories, e.g. "dir/a.jpg", matches the
+            paths ending with it.
 
         :param names: Set, List or Str. Names of the files to find.
         :param disp: If True, results will be printed.
@@ -152,27 +149,62 @@ class FileSet:
         if disp:
             names = sorted(names)
         for n in names:
-            res = []
-            if lower:
-                res += [i for i in self.paths if i.lower().endswith(n.lower())]
+            if os.sep in n or (os.altsep and os.altsep in n):
+                # Names including directories are matched against the end of each path
+                if lower:
+                    # Paths are only converted to lowercase once and reused for all names and subsequent calls
+                    if self._lower_paths is None:
+                        self._lower_paths = ([(i, i) for i in self.paths] if self.lower
+                                             else [(i.lower(), i) for i in self.paths])
+                    n_lower = n.lower()
+                    res = [i for i_lower, i in self._lower_paths if i_lower.endswith(n_lower)]
+                else:
+                    res = [i for i in self.paths if i.endswith(n)]
             else:
-                res += [i for i in self.paths if i.endswith(n)]
+                # File names are looked up directly
+                res = self._get_name_index(lower).get(n.lower() if lower else n, [])
             if res:
                 final_res.update(res)
             if disp:
                 print("\n{}:".format(n))
                 if res:
-                    [print(i) for i in sorted(res)]
+                    print("\n".join(sorted(res)))
                 else:
                     print("No results")
 
         return final_res
 
+    def _get_name_index(self, lower):
+        """ Returns a dictionary of {file name: [paths]}, with lowercase file names if lower is True """
+        index = self._name_indexes.get(lower)
+        if index is None:
+            index = dict()
+            for i in self.paths:
+                name = _basename(i)
+                index.setdefault(name.lower() if lower else name, []).append(i)
+            self._name_indexes[lower] = index
+        return index
+
+    def _get_paths_with_names(self, names):
+        """ Returns the paths of the files with the provided names, without scanning the paths.
+
+        :param names: Set of file names, a subset of self.names
+        :return: Set of paths
+        """
+        if not names:
+            return set()
+        elif len(names) == len(self.names):
+            return set(self.paths)
+        else:
+            # The name index is built once and reused by the following operations on this FileSet
+            index = self._get_name_index(False)
+            return {i for name in names for i in index[name]}
+
     def get_full_paths(self):
         """ Returns the full paths no matter if the class was built with full or relative paths """
         if self.rel_paths:
             root = next(iter(self.rootdirs))
-            return set([os.path.join(root, i) for i in self.paths])
+            return {os.path.join(root, i) for i in self.paths}
         else:
             return self.paths
 
@@ -187,8 +219,9 @@ class FileSet:
         elif isinstance(names, list):
             names = set(names)
 
+        # The set intersection iterates the smaller side, the paths only need to be filtered if some names were dropped
         names = self.names & names
-        paths = [i for i in self.paths if os.path.basename(i) in names]
+        paths = self._get_paths_with_names(names)
         return FileSet(paths, names, self.rootdirs, self.rel_paths, self.lower)
 
     def subtract_names(self, names):
@@ -203,5 +236,79 @@ class FileSet:
             names = set(names)
 
         names = self.names - names
-        paths = [i for i in self.paths if os.path.basename(i) in names]
+        paths = self._get_paths_with_names(names)
         return FileSet(paths, names, self.rootdirs, self.rel_paths, self.lower)
+
+
+def _scan_root(root, rel_paths, lower):
+    """ Scans a root directory for FileSet.build()
+
+    :return: Tuple (paths, names) of the files found
+    """
+    paths = set()
+    names = set()
+
+    # Relative paths are sliced from the full path of the entries instead of being joined again
+    prefix_len = len(os.path.join(root, "")) if rel_paths else 0
+    if lower:
+        for filename, path in _scan_files(root):
+            names.add(filename.lower())
+            paths.add(path[prefix_len:].lower())
+    else:
+        for filename, path in _scan_files(root):
+            names.add(filename)
+            paths.add(path[prefix_len:])
+
+    return paths, names
+
+
+def _scan_files(root):
+    """ Yields a (name, path) tuple for each file found recursively from the root directory.
+        As with os.walk, symbolic links to directories are not followed and unreadable directories are skipped.
+
+    :param root: Path of the directory to scan
+    """
+    dirs = [root]
+    while dirs:
+        try:
+            entries = os.scandir(dirs.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    yield entry.name, entry.path
+                elif not entry.is_symlink():
+                    dirs.append(entry.path)
+
+
+def _ends_with_any(path, rel_paths, depths):
+    """ Checks if a full path ends with any of the relative paths, starting after a path separator.
+        Suffixes of the path are looked up in the set from the file name up, and only at the depths present in the
+        relative paths, so the cost depends on the depth of the relative paths and not on the set size.
+
+    :param path: Full path
+    :param rel_paths: Set of relative paths
+    :param depths: Set of the number of path separators found in each of the relative paths
+    :return: True if a relative path matches the end of the full path
+    """
+    index = len(path)
+    for depth in range(max(depths, default=-1) + 1):
+        index = path.rfind(os.sep, 0, index)
+        if depth in depths and path[index + 1:] in rel_paths:
+            return True
+        if index == -1:
+            break
+    return False
+
+
+def _basename(path):
+    """ Returns the file name of a path. FileSet paths always end with a file name joined with os.sep,
+        so a single partition is enough instead of the more general os.path.basename.
+    """
+    return path.rpartition(os.sep)[2]
+
+
+def _get_depths(rel_paths):
+    """ Returns the set of the number of path separators found in each of the relative paths """
+    return {i.count(os.sep) for i in rel_paths}
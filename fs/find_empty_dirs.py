@@ -13,8 +13,6 @@ if __name__ == "__main__" and __package__ is None:
 
 from shared.utils import print_progress
 
-_scan_count = 0
-
 
 def find_empty_dirs(lib_path: str, ignore_hidden=False, ignore_size=0, remove='prompt'):
     """ Finds empty directories and optionally removes them. A directory is considered empty if it contains no or only
@@ -42,10 +40,11 @@ def find_empty_dirs(lib_path: str, ignore_hidden=False, ignore_size=0, remove='p
     # Check if directories are empty
     msg = "Scanned {} directories"
     empty_dirs = []
-    if _is_empty_recursive(lib_path, msg, empty_dirs, ignore_hidden, ignore_size):
+    is_empty, scan_count = _scan_empty_dirs(lib_path, msg, empty_dirs, ignore_hidden, ignore_size)
+    if is_empty:
         empty_dirs = [entry.path for entry in os.scandir(lib_path) if entry.is_dir(follow_symlinks=False)]
 
-    print_progress(msg, _scan_count, final=True)
+    print_progress(msg, scan_count, final=True)
     print()
     if len(empty_dirs):
         if (remove == "yes" or
@@ -63,46 +62,86 @@ def find_empty_dirs(lib_path: str, ignore_hidden=False, ignore_size=0, remove='p
             if errors:
                 print()
                 print("Some errors occurred:")
-                [print(e) for e in errors]
+                print("\n".join(errors))
         else:
-            [print(d) for d in empty_dirs]
+            print("\n".join(empty_dirs))
             print()
             print("The above directories are empty")
     else:
         print("No empty directories found")
 
 
-def _is_empty_recursive(path, msg, empty_dirs, ignore_hidden, ignore_size):
+def is_empty_dir(path, ignore_hidden=False, ignore_size=0):
+    """ Returns True if the directory is empty, following the same rules as find_empty_dirs
+    :param path: Path of the directory to check
+    :param ignore_hidden: If True, hidden files will be ignored
+    :param ignore_size: Size in KB below which files will be ignored.
+    :return: True if the directory is empty, False if it is not or can't be read
+    """
+    try:
+        return _scan_empty_dirs(path, None, [], ignore_hidden, ignore_size*1024)[0]
+    except OSError:
+        return False
+
+
+def _scan_empty_dirs(path, msg, empty_dirs, ignore_hidden, ignore_size):
+    """ Scans the directory tree from path and adds the empty directories found to empty_dirs.
+        Only the top-most empty directories are added, as their empty subdirectories are removed along with them.
+        The tree is walked with an explicit stack to avoid recursion limits on deep trees.
+        Progress is printed with msg, unless it is None.
 
-    global _scan_count
-    _scan_count += 1
-    print_progress(msg, _scan_count)
+    :return: Tuple (True if the directory at path is empty, number of directories scanned)
+    """
+    scan_count = 1
+    if msg is not None:
+        print_progress(msg, scan_count)
+    stack = [_new_scan_frame(path)]
+    is_empty = True
+
+    while stack:
+        frame = stack[-1]
+        for entry in frame['entries']:
+            # Subdirectories are always scanned, as empty directories must be found even inside non-empty ones,
+            # but once the directory is known to be non-empty, the remaining files don't need to be checked
+            if entry.is_dir(follow_symlinks=False):
+                scan_count += 1
+                if msg is not None:
+                    print_progress(msg, scan_count)
+                stack.append(_new_scan_frame(entry.path))
+                break
+            elif not (frame['has_files'] or frame['has_non_empty_dirs']) and entry.is_file(follow_symlinks=False):
+                if not ((ignore_hidden and is_hidden(entry))
+                        or (ignore_size and (entry.stat(follow_symlinks=False).st_size < ignore_size))):
+                    frame['has_files'] = True
+        else:
+            # All entries were scanned, pass the result to the parent directory
+            stack.pop()
+            is_empty = not (frame['has_files'] or frame['has_non_empty_dirs'])
+            if not is_empty:
+                empty_dirs += frame['empty_dirs']
+            if stack:
+                if is_empty:
+                    stack[-1]['empty_dirs'] += [frame['path']]
+                else:
+                    stack[-1]['has_non_empty_dirs'] = True
 
-    local_empty_dirs = []
-    has_files = False
-    has_non_empty_dirs = False
+    return is_empty, scan_count
 
-    for entry in os.scandir(path):
-        if entry.is_file(follow_symlinks=False) and not has_files:
-            if not ((ignore_hidden and is_hidden(entry))
-                    or (ignore_size and (entry.stat(follow_symlinks=False).st_size < ignore_size))):
-                has_files = True
-        elif entry.is_dir(follow_symlinks=False):
-            if _is_empty_recursive(entry.path, msg, empty_dirs, ignore_hidden, ignore_size):
-                local_empty_dirs += [entry.path]
-            else:
-                has_non_empty_dirs = True
 
-    if has_non_empty_dirs or has_files:
-        empty_dirs += local_empty_dirs
-        return False
-    else:
-        return True
+def _new_scan_frame(path):
+    """ Returns the scan state of a directory for _scan_empty_dirs """
+    return {'path': path, 'entries': os.scandir(path), 'empty_dirs': [], 'has_files': False,
+            'has_non_empty_dirs': False}
 
 
 def is_hidden(entry):
-    """ Returns True if the file is a hidden file, False otherwise """
-    return entry.name.startswith('.') or bool(entry.stat(follow_symlinks=False).st_file_attributes & stat.FILE_ATTRIBUTE_HIDDEN)
+    """ Returns True if the file is a hidden file, False otherwise
+        The hidden attribute only exists on Windows, where the stat result comes from the directory scan without a
+        syscall. Elsewhere, only the name is checked so no stat is needed.
+    """
+    if entry.name.startswith('.'):
+        return True
+    return os.name == 'nt' and bool(entry.stat(follow_symlinks=False).st_file_attributes & stat.FILE_ATTRIBUTE_HIDDEN)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,12 @@
 """ Shared functions for the other modules """
 
+import os
 import time
 from datetime import datetime
 
+# Number of threads for file system bound work, which mostly waits on the disk or the network
+IO_WORKERS = min(32, (os.cpu_count() or 1) * 2)
+
 
 def print_progress(msg, *args, show_time=True, init=False, final=False):
     """ Throttles printing and updates the progress of a process on a single line
@@ -13,22 +17,27 @@ def print_progress(msg, *args, show_time=True, init=False, final=False):
     :param init: If true, resets elapsed time
     :param final: If true, throttling is ignored and the message is ended with a new line character
     """
-    if final or time.time() > print_progress.prev_call + 1 or print_progress.prev_call_final or init:
-        end = "\n" if final else "\r"
-        msg = time_brackets(init=init) + msg if show_time else msg
-        msg = msg.format(*args)
-        if len(msg) > print_progress.pad_len:
-            print_progress.pad_len = len(msg)
-        print(msg.ljust(print_progress.pad_len), end=end, flush=True)
-        print_progress.prev_call = time.time()
-        if final:
-            print_progress.prev_call_final = True
-            print_progress.pad_len = 0
-        else:
-            print_progress.prev_call_final = False
+    # Flags are checked before reading the clock and the message is only formatted once the throttle is passed,
+    # to keep throttled calls cheap in tight loops
+    if not (final or init or print_progress.prev_call_final):
+        if time.monotonic() < print_progress.prev_call + print_progress.interval:
+            return
+    end = "\n" if final else "\r"
+    msg = time_brackets(init=init) + msg if show_time else msg
+    msg = msg.format(*args)
+    if len(msg) > print_progress.pad_len:
+        print_progress.pad_len = len(msg)
+    print(msg.ljust(print_progress.pad_len), end=end, flush=True)
+    print_progress.prev_call = time.monotonic()
+    if final:
+        print_progress.prev_call_final = True
+        print_progress.pad_len = 0
+    else:
+        print_progress.prev_call_final = False
 print_progress.prev_call_final = False
-print_progress.prev_call = 0
+print_progress.prev_call = float('-inf')
 print_progress.pad_len = 0
+print_progress.interval = 1  # Minimum number of seconds between two throttled updates
 
 
 def time_elapsed(init=False, text=True):
@@ -1,14 +1,65 @@
 """ Shared video related functions for the other modules """
 
+import functools
 import langcodes
 import os
 import re
+import sys
+
+# The collections are defined once and immutable, so they can be returned as is, with sets for fast membership tests
+_VIDS_EXTRA_TAGS = ("trailer", "sample", "-scene", "-clip", "-interview", "-behindthescenes", "-deleted",
+                    "-deletedscene", "-featurette", "-short", "-other", "-extra")
+_SUPPORTED_SUB_TAGS = frozenset(("sdh", "cc", "forced", "foreign", "default"))
+_SUPPORTED_SUB_EXTENSIONS = frozenset(("srt", "ass", "ssa", "vtt", "sub"))
+_SUPPORTED_VIDEO_EXTENSIONS = frozenset(("mkv", "mk3d", "mka", "mks", "webm",
+                                         "mp4", "m4a", "m4p", "m4b", "m4r", "m4v",
+                                         "mpg", "mp2", "mpeg", "mpe", "mpv", "m2v",
+                                         "mov", "movie", "qt",
+                                         "avi", "divx", "wmv",
+                                         "ogv", "ogg", "vob"))
+# Directories created by NAS systems, which never hold library files
+_SKIPPED_DIRS = frozenset(("@eaDir", "#recycle", "#snapshot"))
+
+_HEARING_IMPAIRED_RE = re.compile("hearing.?impaired")
 
 
 def get_vids_extra_tags():
-    """ Returns a list of tags which indicate that a video file is "extra" when at the end of the file name """
-    return ["trailer", "sample", "-scene", "-clip", "-interview", "-behindthescenes", "-deleted",
-            "-deletedscene", "-featurette", "-short", "-other", "-extra"]
+    """ Returns a tuple of tags which indicate that a video file is "extra" when at the end of the file name """
+    return _VIDS_EXTRA_TAGS
+
+
+def is_skipped_dir(name):
+    """ Returns True if a directory should not be scanned for media files: trickplay images, hidden directories and
+        directories created by NAS systems
+    :param name: The name of the directory
+    """
+    return name.endswith(".trickplay") or name.startswith(".") or name in _SKIPPED_DIRS
+
+
+@functools.lru_cache(maxsize=4096)
+def find_language_tag(name):
+    """ Returns the BCP-47 tag of a full language name, or an empty string if the language wasn't found.
+        Results are cached since the same few languages are looked up for a whole library, and interned so they
+        compare by identity with literals and dictionary keys.
+    """
+    try:
+        return sys.intern(langcodes.find(name).to_tag())
+    except LookupError:
+        return ''
+
+
+@functools.lru_cache(maxsize=4096)
+def get_language_tag(code):
+    """ Returns the standardized BCP-47 tag of a language code, or an empty string if the code isn't valid.
+        Results are cached since the same few languages are looked up for a whole library, and interned so they
+        compare by identity with literals and dictionary keys.
+    """
+    try:
+        if langcodes.Language.get(code).is_valid():
+            return sys.intern(langcodes.standardize_tag(code))
+    except langcodes.tag_parser.LanguageTagError:
+        pass
+    return ''
 
 
 def get_sub_tags_from_file_name(filename):
@@ -19,33 +70,27 @@ def get_sub_tags_from_file_name(filename):
     lang = ''
     tags = []
     full_text_tags = []
-    parts = os.path.splitext(filename)[0].split(".")
+    # Only the last 4 parts are used, so the name is lowered once and split no further than needed
+    parts = os.path.splitext(filename)[0].lower().rsplit(".", 4)
     for i, part in enumerate(reversed(parts)):
         # Check the supported tags first as there are collisions with languages (such as sdh)
-        part = part.lower()
-        if part in get_supported_sub_tags():
+        if part in _SUPPORTED_SUB_TAGS:
             if part not in tags:
                 tags += [part]
         elif not lang:
             if len(part) <= 3:
-                try:
-                    if langcodes.Language.get(part).is_valid():
-                        lang = langcodes.standardize_tag(part)
-                except langcodes.tag_parser.LanguageTagError:
-                    pass
+                lang = get_language_tag(part)
             else:
                 # Is a full language name used?
-                try:
-                    lang = langcodes.find(part).to_tag()
+                lang = find_language_tag(part)
+                if lang:
                     # In this case full text tags may also be in the same tag
                     if "-forced" in part:
                         full_text_tags += ["forced"]
                     if "-foreign" in part:
                         full_text_tags += ["foreign"]
-                    if re.search("hearing.?impaired", part) or "-sdh" in part:
+                    if _HEARING_IMPAIRED_RE.search(part) or "-sdh" in part:
                         full_text_tags += ["sdh"]
-                except LookupError:
-                    pass
 
         # Max of 4 tags
         if i >= 3:
@@ -61,20 +106,15 @@ def get_sub_tags_from_file_name(filename):
 
 
 def get_supported_sub_tags():
-    """ Returns a list of the supported sub tags """
-    return ["sdh", "cc", "forced", "foreign", "default"]
+    """ Returns a frozenset of the supported sub tags """
+    return _SUPPORTED_SUB_TAGS
 
 
 def get_supported_sub_extensions():
-    """ Returns a list of all """
-    return ["srt", "ass", "ssa", "vtt", "sub"]
+    """ Returns a frozenset of all supported sub extensions """
+    return _SUPPORTED_SUB_EXTENSIONS
 
 
 def get_supported_video_extensions():
-    """ Returns a list of all video file extensions """
-    return ["mkv", "mk3d", "mka", "mks", "webm",
-            "mp4", "m4a", "m4p", "m4b", "m4r", "m4v",
-            "mpg", "mp2", "mpeg", "mpe", "mpv", "m2v",
-            "mov", "movie", "qt",
-            "avi", "divx", "wmv",
-            "ogv", "ogg", "vob"]
+    """ Returns a frozenset of all video file extensions """
+    return _SUPPORTED_VIDEO_EXTENSIONS
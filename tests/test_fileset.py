@@ -0,0 +1,41 @@
+import os
+import tempfile
+import unittest
+
+from fs.FileSet import FileSet
+
+
+class TestFileSetFind(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        for path in ("a.jpg", "data.jpg", os.path.join("Photos", "A.jpg"), os.path.join("Other", "a.jpg")):
+            full_path = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            open(full_path, "w").close()
+        self.fs = FileSet.build(self.root)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_bare_name_matches_whole_file_names(self):
+        res = self.fs.find("a.jpg", disp=False)
+        self.assertEqual(res, {os.path.join(self.root, "a.jpg"), os.path.join(self.root, "Photos", "A.jpg"),
+                               os.path.join(self.root, "Other", "a.jpg")})
+
+    def test_bare_name_case_sensitive(self):
+        res = self.fs.find("a.jpg", disp=False, lower=False)
+        self.assertEqual(res, {os.path.join(self.root, "a.jpg"), os.path.join(self.root, "Other", "a.jpg")})
+
+    def test_name_with_directory_matches_path_suffix(self):
+        res = self.fs.find(os.path.join("photos", "a.jpg"), disp=False)
+        self.assertEqual(res, {os.path.join(self.root, "Photos", "A.jpg")})
+        res = self.fs.find(os.path.join("photos", "a.jpg"), disp=False, lower=False)
+        self.assertEqual(res, set())
+
+    def test_missing_name(self):
+        self.assertEqual(self.fs.find("ata.jpg", disp=False), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 import argparse
+import codecs
+import functools
 import os
 import re
 import spacy
 import srt
 import sys
 import langcodes
+from concurrent.futures import ProcessPoolExecutor
 
 # Allow relative import from shared folder as per PEP 366
 if __name__ == "__main__" and __package__ is None:
@@ -14,14 +17,27 @@ if __name__ == "__main__" and __package__ is None:
     __package__ = "media-library-helper"
 
 from shared.utils import print_progress
-from shared.vid_utils import get_sub_tags_from_file_name
+from shared.vid_utils import get_sub_tags_from_file_name, is_skipped_dir
 from video.clean_subs_string_data import dirty_strings
 
 supported_sub_formats = ["srt"]
 _spacy_models = dict()
-
-
-def clean_subs(lib_path: str, spacy_models, spacy_models_languages, force_cap=False, force_tags=False, ignore_parse_errors=False, keep_dirty=True):
+_TAG_RE = re.compile(r'<.*?>')
+_FONT_RE = re.compile(r'</?font.*?>')
+_B_RE = re.compile(r'</?b>')
+_TOKEN_CACHE_SIZE = 50000
+# Only the part of speech of tokens is used, so the spacy components below are disabled to save processing time.
+# The attribute_ruler is kept as some models (English) use it to map fine-grained tags to parts of speech.
+_UNUSED_SPACY_COMPONENTS = ("parser", "ner", "lemmatizer", "senter")
+# Punctuation marks that indicate the end of a sentence
+# Colons are most used to show who speaks while brackets may be used for identifying
+# characters or background sounds. Other punctuation may be missing before a new sentence starts.
+# "..." is not used as it is sometimes used to indicate that the sentence continues in the next subtitle
+_SENTENCE_PUNCTUATION = frozenset(['.', '!', '?', ':', '(', ')', '[', ']'])
+
+
+def clean_subs(lib_path: str, spacy_models, spacy_models_languages, force_cap=False, force_tags=False, ignore_parse_errors=False, keep_dirty=True,
+               n_procs=1):
     """ Clean common unwanted strings from subtitles recursively from the specified directory.
         For full functionality, subtitles files need to be named following the jellyfin external file tagging standard
         (https://jellyfin.org/docs/general/server/media/external-files/), with a 2 or 3 letter language code
@@ -35,6 +51,8 @@ def clean_subs(lib_path: str, spacy_models, spacy_models_languages, force_cap=Fa
                                     for example, the wrong file encoding was used.
         :param keep_dirty: If True, dirty subs will be kept in addition to the cleaned subs, but their extension
                            will be changed to .dirty
+        :param n_procs: Number of processes used to clean files concurrently. Each process loads its own spacy models,
+                        so memory use grows with n_procs, and deep clean progress is only shown when n_procs is 1.
         :return: 0 if the process ran successfully
         """
 
@@ -44,36 +62,56 @@ def clean_subs(lib_path: str, spacy_models, spacy_models_languages, force_cap=Fa
         return 1
 
     assert len(spacy_models) == len(spacy_models_languages), "Number of models and languages not the same"
+    if n_procs < 1:
+        n_procs = 1
+        print("n_procs should be >= 1, value reset to default {}".format(n_procs))
+    model_names = dict()
     for i in range(len(spacy_models)):
-        #  Store the model string for now, the model is loaded only if needed
-        _spacy_models[langcodes.standardize_tag(spacy_models_languages[i])] = spacy_models[i]
+        model_names[sys.intern(langcodes.standardize_tag(spacy_models_languages[i]))] = spacy_models[i]
+    #  Store the model string for now, the model is loaded only if needed
+    _spacy_models.update(model_names)
 
-    # Find subtitles and clean them
+    # Find subtitles
     msg = "Scanned {} subtitles files of which {} have been modified"
+    sub_files = []
+    sub_suffixes = tuple("." + ext for ext in supported_sub_formats)
+    for root, dirs, files in os.walk(lib_path, topdown=True):
+        dirs[:] = [d for d in dirs if not is_skipped_dir(d)]
+        sub_files += [(file, os.path.join(root, file)) for file in files if file.lower().endswith(sub_suffixes)]
+
+    # Clean them, in worker processes if more than one process is requested
     sub_count = 0
     changed = []
     errors = []
-    for root, dirs, files in os.walk(lib_path, topdown=True):
-        dirs[:] = [d for d in dirs if not d.endswith(".trickplay")]
-        print_progress(msg, sub_count, len(changed))
-        for file in files:
-            file_ext = os.path.splitext(file)[1][1:].lower()
-            if file_ext in supported_sub_formats:
-                sub_count += 1
-                filepath = os.path.join(root, file)
-                res = _clean(file, filepath, force_cap, force_tags, msg, [sub_count, len(changed)], ignore_parse_errors, keep_dirty)
-                if res["modified"]:
-                    changed += [filepath]
-                if res["language_missing"]:
-                    errors += ["Could not capitalize file due to missing language model or undetermined file language: "
-                               + filepath]
-                if res['file_error']:
-                    errors += ["Could not find encoding needed to open file :" + filepath]
-                if res['file_empty']:
-                    errors += ["File seems empty :" + filepath]
-                if res['parse_error']:
-                    errors += ["Parse error in file while using encoding {}. "
-                               "Try converting file to UTF-8 before ignoring parse errors. :".format(res['parse_error']) + filepath]
+    print_progress(msg, sub_count, len(changed))
+    executor = None
+    if n_procs > 1 and len(sub_files) > 1:
+        executor = ProcessPoolExecutor(max_workers=n_procs, initializer=_init_worker, initargs=(model_names,))
+        clean = functools.partial(_clean, force_cap=force_cap, force_tags=force_tags, progress_msg=None,
+                                  msg_args=None, ignore_parse_errors=ignore_parse_errors, keep_dirty=keep_dirty)
+        results = executor.map(clean, *zip(*sub_files), chunksize=16)
+    else:
+        results = (_clean(file, filepath, force_cap, force_tags, msg, [sub_count + 1, len(changed)],
+                          ignore_parse_errors, keep_dirty) for file, filepath in sub_files)
+    try:
+        for (file, filepath), res in zip(sub_files, results):
+            sub_count += 1
+            if res["modified"]:
+                changed += [filepath]
+            if res["language_missing"]:
+                errors += ["Could not capitalize file due to missing language model or undetermined file language: "
+                           + filepath]
+            if res['file_error']:
+                errors += ["Could not find encoding needed to open file :" + filepath]
+            if res['file_empty']:
+                errors += ["File seems empty :" + filepath]
+            if res['parse_error']:
+                errors += ["Parse error in file while using encoding {}. "
+                           "Try converting file to UTF-8 before ignoring parse errors. :".format(res['parse_error']) + filepath]
+            print_progress(msg, sub_count, len(changed))
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
 
     print_progress(msg, sub_count, len(changed), final=True)
     print("All subtitles cleaned!")
@@ -96,32 +134,32 @@ def capitalize(sub, new_sentence, language):
     :param language: Language code indicating which spacy model to use
     :return: A tuple (capitalized subtitle object, bool new sentence indicator)
     """
+    return _capitalize_tokens(sub, next(_tokenize(language, [sub.content])), new_sentence, language)
 
-    # Punctuation marks that indicate the end of a sentence
-    punctuation = ['.', '!', '?', ':', '(', ')', '[', ']']
-    # Colons are most used to show who speaks while brackets may be used for identifying
-    # characters or background sounds. Other punctuation may be missing before a new sentence starts.
-    # "..." is not used as it is sometimes used to indicate that the sentence continues in the next subtitle
 
-    tokens = _spacy_models[language](sub.content)
-    sub.content = ""
+def _capitalize_tokens(sub, tokens, new_sentence, language):
+    """ Capitalizes a subtitle from the already computed tokens of its content, see capitalize
+    :param tokens: Tokens of the subtitle content, as returned by _tokenize
+    """
+    parts = []
     # Capitalize only proper nouns and the first word of sentences
-    for i, token in enumerate(tokens):
-        if (new_sentence or token.pos_ == 'PROPN') and (token.is_alpha or _is_alpha_like(token.text)):
-            sub.content += token.text_with_ws.capitalize()
+    for text, text_with_ws, pos, is_alpha in tokens:
+        if (new_sentence or pos == 'PROPN') and (is_alpha or _is_alpha_like(text)):
+            parts.append(text_with_ws.capitalize())
             new_sentence = False
         else:
             # Is the next word in a new sentence?
-            if token.text in punctuation:
-                sub.content += token.text_with_ws
+            if text in _SENTENCE_PUNCTUATION:
+                parts.append(text_with_ws)
                 new_sentence = True
             # Capitalize I properly in english
-            elif language == 'en' and (token.text.lower() == "i" or "i'" in token.text.lower()):
-                sub.content += token.text_with_ws.capitalize()
+            elif language == 'en' and ((low := text.lower()) == "i" or low.startswith("i'")):
+                parts.append(text_with_ws.capitalize())
             else:
                 # Call lower() to be safe, some tokens containing letters may seep through the condition above
-                sub.content += token.text_with_ws.lower()
+                parts.append(text_with_ws.lower())
 
+    sub.content = "".join(parts)
     return sub, new_sentence
 
 
@@ -137,17 +175,29 @@ def _clean(file, filepath, force_cap, force_tags, progress_msg, msg_args, ignore
     result['removed_tags'] = False
     result['parse_error'] = False
 
-    encodings = ['utf-8-sig', 'utf-16', 'cp1252', 'ISO-8859-1']
     subs = ""
 
-    # Try the most common file encoding to open the file
-    for enc in encodings:
-        try:
-            with open(filepath, "r", encoding=enc) as f:
-                subs = f.read()
-            break
-        except Exception:
-            pass
+    # Read the file only once, then try the most common file encodings to decode it
+    try:
+        with open(filepath, "rb") as f:
+            raw = f.read()
+    except OSError:
+        raw = b""
+    if raw:
+        # UTF-16 is only used when the file starts with a BOM, otherwise almost any data would decode
+        if raw.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            encodings = ['utf-16', 'cp1252', 'ISO-8859-1']
+        else:
+            encodings = ['utf-8-sig', 'cp1252', 'ISO-8859-1']
+        for enc in encodings:
+            try:
+                subs = raw.decode(enc)
+                break
+            except UnicodeDecodeError:
+                pass
+        # Normalize line endings as done when reading in text mode
+        if "\r" in subs:
+            subs = subs.replace("\r\n", "\n").replace("\r", "\n")
 
     if not subs:
         result['file_error'] = True
@@ -189,33 +239,34 @@ def _clean(file, filepath, force_cap, force_tags, progress_msg, msg_args, ignore
         result['modified'] = True
 
     # Check the first 40 subs with a more limited range of strings, as sometimes ads are inserted there too...
-    dirty_subs = []
-    for i in range(min(40, len(subs))):
-        if _is_dirty(subs[i].content, late=True):
-            dirty_subs += [i]
-    if dirty_subs:
-        subs = [sub for i, sub in enumerate(subs) if i not in dirty_subs]
+    # The flags needed to check the first subs for all-caps and font tags are computed in the same pass
+    flags = [_sample_flags(sub.content) for sub in subs[:40]]
+    if any(f[0] for f in flags):
+        subs = [sub for sub, f in zip(subs, flags) if not f[0]] + subs[len(flags):]
+        flags = [f for f in flags if not f[0]]
         result['modified'] = True
+    if len(flags) < 30:
+        flags += [_sample_flags(sub.content) for sub in subs[len(flags):30]]
 
     # Check the first subs to see if they are all-caps or all contain font tags,
     # Sometimes, only a portion of subs are affected so check many
-    all_caps = 0
-    unwanted_tags = 0
-    for i in range(min(30, len(subs))):
-        if _is_all_caps(subs[i].content):
-            all_caps += 1
-        if not unwanted_tags and _has_unwanted_tags(subs[i].content):
-            unwanted_tags += 1
+    all_caps = sum(f[1] for f in flags[:30])
+    unwanted_tags = any(f[2] for f in flags[:30])
 
     if all_caps > 10 or force_cap:
-        long_process = " - {} needs deep cleaning {}/{}"
+        long_process = progress_msg + " - {} needs deep cleaning {}/{}".ljust(45) if progress_msg is not None else None
         new_sentence = True
         tags = get_sub_tags_from_file_name(file)
         if tags and _load_spacy_model(tags[0]):
+            lang = tags[0]
             total = len(subs)
-            for i, sub in enumerate(subs):
-                print_progress(progress_msg + long_process.ljust(45), *msg_args, file, i, total)
-                subs[i], new_sentence = capitalize(sub, new_sentence, tags[0])
+            tokenized = _tokenize(lang, [sub.content for sub in subs])
+            for i, (sub, tokens) in enumerate(zip(subs, tokenized)):
+                # Only refresh the progress every 32 subs, as it's expensive compared to short subs
+                if long_process is not None and (i & 31) == 0:
+                    print_progress(long_process, *msg_args, file, i, total)
+                # Subs are capitalized in place
+                new_sentence = _capitalize_tokens(sub, tokens, new_sentence, lang)[1]
             result['modified'] = True
             result['capitalized'] = True
         else:
@@ -230,31 +281,43 @@ def _clean(file, filepath, force_cap, force_tags, progress_msg, msg_args, ignore
         if keep_dirty:
             os.replace(filepath, filepath + ".dirty")
         with open(filepath, "w", encoding='utf-8-sig') as f:
-            f.write(srt.compose(subs, reindex=True))
+            # Same output as srt.compose(subs, reindex=True), written block by block instead of as one big string
+            f.writelines(sub.to_srt() for sub in srt.sort_and_reindex(subs, in_place=True))
 
     return result
 
 
 def _get_dirty_strings(late):
-    """ Returns a list of dirty strings to compare against subs content """
-    if not _get_dirty_strings.dirty_strings:
-        global dirty_strings
-        for lang, subdict in dirty_strings.items():
-            for type, dirtlist in subdict.items():
-                _get_dirty_strings.dirty_strings += dirtlist
-                if type == 'late':
-                    _get_dirty_strings.dirty_strings_late += dirtlist
-    if late:
-        return _get_dirty_strings.dirty_strings_late
-    else:
-        return _get_dirty_strings.dirty_strings
-_get_dirty_strings.dirty_strings = []
-_get_dirty_strings.dirty_strings_late = []
+    """ Builds the matchers used to compare against subs content
+    :param late: Only use the more limited 'late' set of dirty strings
+    :return: A tuple (compiled pattern matching any plain dirty string or None, tuple of 'surround' strings)
+    """
+    plain = []
+    surround = []
+    for lang, subdict in dirty_strings.items():
+        for type, dirtlist in subdict.items():
+            if late and type != 'late':
+                continue
+            for dirt in dirtlist:
+                # Contents are compared in lower case, so the strings are lowered once here
+                if isinstance(dirt, tuple):
+                    if dirt[0] == 'surround':
+                        surround.append(dirt[1].lower())
+                else:
+                    plain.append(dirt.lower())
+    # A single alternation scans the content once instead of once per dirty string
+    pattern = re.compile("|".join(re.escape(d) for d in plain)) if plain else None
+    return pattern, tuple(surround)
+
+
+# Built once at import
+_DIRTY_MATCHERS = _get_dirty_strings(late=False)
+_DIRTY_MATCHERS_LATE = _get_dirty_strings(late=True)
 
 
 def _has_unwanted_tags(content):
     """ Checks if a subtitle has unwanted formatting tags """
-    return re.match(r'</?font.*?>', content) or re.match(r'</?b>', content)
+    return _FONT_RE.match(content) is not None or _B_RE.match(content) is not None
 
 
 def _is_all_caps(content):
@@ -263,10 +326,16 @@ def _is_all_caps(content):
     :return: True if the content is all caps
     """
     # Remove any possible HTML tags
-    content = re.sub(r'<.*?>', '', content)
+    if '<' in content:
+        content = _TAG_RE.sub('', content)
     return content.isupper()
 
 
+def _init_worker(model_names):
+    """ Initializes a worker process with the names of the spacy models, which are loaded only if needed """
+    _spacy_models.update(model_names)
+
+
 def _is_alpha_like(text):
     """ Checks if a string is composed of only apostrophes and letters, with at least one letter """
     return all(char.isalpha() or char == "'" for char in text) and len(text) > 1
@@ -280,21 +349,44 @@ def _is_dirty(content, late=False):
     """
 
     # Sometimes dirt may be hidden - split by some tags, so remove them
-    content = re.sub(r'<.*?>', '', content).lower()
-
-    # Check if the content is dirty
-    for dirt in _get_dirty_strings(late=late):
-        if type(dirt) == tuple:
-            if (dirt[0] == 'surround'
-                    and len(content) > 2*len(dirt[0])
-                    and content.startswith(dirt[0])
-                    and content.endswith(dirt[0])):
-                return True
-        elif dirt in content:
+    if '<' in content:
+        content = _TAG_RE.sub('', content)
+    return _is_dirty_lowered(content.lower(), late)
+
+
+def _is_dirty_lowered(content, late=False):
+    """ Same as _is_dirty, for a content from which tags have already been removed and which is in lower case """
+    pattern, surround = _DIRTY_MATCHERS_LATE if late else _DIRTY_MATCHERS
+    if pattern is not None and pattern.search(content):
+        return True
+    for dirt in surround:
+        if len(content) > 2*len(dirt) and content.startswith(dirt) and content.endswith(dirt):
             return True
     return False
 
 
+def _tokenize(lang, texts):
+    """ Tokenizes texts with the spacy model of a language. Results are cached as many subtitles repeat
+    across files, and texts not found in the cache are processed in batches, which is much faster than calling
+    the model once per text.
+    :param lang: Language code of the model to use, which must be loaded
+    :param texts: List of texts to tokenize
+    :return: Generator yielding, for each text, a tuple of tokens (text, text_with_ws, pos_, is_alpha)
+    """
+    cache = _tokenize.cache
+    if len(cache) > _TOKEN_CACHE_SIZE:
+        cache.clear()
+    missing = [text for text in dict.fromkeys(texts) if (lang, text) not in cache]
+    docs = _spacy_models[lang].pipe(missing, batch_size=256)
+    for text in texts:
+        key = (lang, text)
+        if key not in cache:
+            # Texts missing from the cache are met in the same order as they were passed to the model
+            cache[key] = tuple((t.text, t.text_with_ws, t.pos_, t.is_alpha) for t in next(docs))
+        yield cache[key]
+_tokenize.cache = dict()
+
+
 def _load_spacy_model(lang):
     """Try loading a Spacy model for the specified language.
     :param lang: language code
@@ -303,19 +395,28 @@ def _load_spacy_model(lang):
     if lang in _spacy_models:
         # Load the model on first use
         if type(_spacy_models[lang]) is str:
-            _spacy_models[lang] = spacy.load(_spacy_models[lang])
+            nlp = spacy.load(_spacy_models[lang])
+            nlp.select_pipes(disable=[name for name in _UNUSED_SPACY_COMPONENTS if name in nlp.pipe_names])
+            _spacy_models[lang] = nlp
         return True
     else:
         return False
 
 
+def _sample_flags(content):
+    """ Checks a subtitle for late dirty strings, all caps and unwanted tags, removing its tags only once
+    :param content: Content of a subtitle
+    :return: A tuple of bools (is dirty, is all caps, has unwanted tags)
+    """
+    stripped = _TAG_RE.sub('', content) if '<' in content else content
+    return (_is_dirty_lowered(stripped.lower(), late=True),
+            stripped.isupper(),
+            _has_unwanted_tags(content))
+
+
 def _remove_unwanted_tags(sub):
     """ Remove unwanted tags from a subtitle """
-    content = sub.content
-    content = re.sub(r'</?font.*?>', '', content)
-    content = re.sub(r'</?b>', '', content)
-
-    sub.content = content
+    sub.content = _B_RE.sub('', _FONT_RE.sub('', sub.content))
     return sub
 
 
@@ -326,6 +427,9 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--languages', type=str, nargs='+', help='language codes of the models')
     parser.add_argument('-fc', '--force_cap', action='store_true', help='Forces capitalizing the text (very slow)')
     parser.add_argument('-ft', '--force_tag', action='store_true', help='Forces tag removal (slow)')
+    parser.add_argument('-n', '--n_procs', type=int, default=1,
+                        help='Number of files to clean concurrently. Each process loads its own copy of the spacy '
+                             'models, so memory use is multiplied accordingly. Deep clean progress is only shown with 1.')
     parser.add_argument('-i', '--ignore_parse_errors', action='store_true',
                         help='Ignore parsing errors when reading the srt file. Note that this can delete data from '
                              'your file if, for example, the wrong file encoding was used.')
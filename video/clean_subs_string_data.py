@@ -5,6 +5,7 @@
      wanted subtitles as unwanted.
 
      Each entry can be a string or a tuple containing a modifier and a string.
+     Strings are compared in lower case. The collections are tuples as they are only read.
 
      Modifiers are:
      - surround: Only makes dirty if the sub starts and ends with the string
@@ -15,7 +16,7 @@ dirty_strings = dict()
 
 # English
 dirty_strings["en"] = dict()
-dirty_strings["en"]["early"] = [
+dirty_strings["en"]["early"] = (
     "captioning sponsored",
     "captioned by",
     "clearway law",
@@ -39,38 +40,38 @@ dirty_strings["en"]["early"] = [
     "==",
     "-=",
     ('surround', "--"),
-    ('surround', "**")
-]
+    ('surround', "**"),
+)
 
-dirty_strings["en"]["late"] = [
+dirty_strings["en"]["late"] = (
     "opensubtitles",
     "subtitle by",
-    "subtitles by"
-]
+    "subtitles by",
+)
 
 # French
 dirty_strings["fr"] = dict()
-dirty_strings["fr"]["early"] = [
+dirty_strings["fr"]["early"] = (
     "traduit par",
     "traduction",
-    "corrections"
-]
+    "corrections",
+)
 
-dirty_strings["fr"]["late"] = [
+dirty_strings["fr"]["late"] = (
     "sous-titre par",
     "sous-titres par",
     "sous-titre de",
     "sous-titres de",
     "sous-titrage",
-    "vostfr"
-]
+    "vostfr",
+)
 
 # Swedish
 dirty_strings["sv"] = dict()
-dirty_strings["sv"]["early"] = [
-    "översättning"
-]
+dirty_strings["sv"]["early"] = (
+    "översättning",
+)
 
-dirty_strings["sv"]["late"] = []
+dirty_strings["sv"]["late"] = ()
 
 
@@ -1,12 +1,22 @@
 #!/usr/bin/env python
 """ Extracts subtitles from video files recursively starting from the specified directory """
 import argparse
-import json
+import collections
+import fnmatch
+import functools
 import os
+import subprocess
 import sys
+import threading
 import langcodes
+from concurrent.futures import ThreadPoolExecutor
 
 from ffmpeg import FFmpeg, Progress
+try:
+    # Faster JSON parser for the ffprobe output, if installed
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Allow relative import from shared folder as per PEP 366
 if __name__ == "__main__" and __package__ is None:
@@ -14,7 +24,8 @@ if __name__ == "__main__" and __package__ is None:
     sys.path.insert(1, parent_dir)
     __package__ = "media-library-helper"
 
-from shared.utils import print_progress
+from shared.utils import IO_WORKERS, print_progress
+from shared.vid_utils import get_language_tag, is_skipped_dir
 
 supported_video_formats = ["mkv", "mk3d", "mka", "mks", "webm",
                            "mp4", "m4a", "m4p", "m4b", "m4r", "m4v",
@@ -22,9 +33,18 @@ supported_video_formats = ["mkv", "mk3d", "mka", "mks", "webm",
 
 supported_sub_formats = ["srt", "ass", "ssa", "vtt"]
 
+_SUPPORTED_VIDEO_FORMATS_SET = frozenset(supported_video_formats)
+# Serializes progress output from the extraction threads
+_print_lock = threading.Lock()
+_FFPROBE_ENTRIES = "stream=index,codec_type,codec_name:stream_tags=language,title"
+# Codec of each subtitle format, streams already in that codec are copied instead of being converted
+_SUB_FORMAT_CODECS = {".srt": "subrip", ".ass": "ass", ".ssa": "ass", ".vtt": "webvtt"}
+# Image based subtitle codecs (and HDMV text subtitles, which ffmpeg can't decode) can't be extracted to text formats
+_EXCLUDED_SUB_CODECS = frozenset(["dvd_subtitle", "dvb_subtitle", "hdmv_pgs_subtitle", "hdmv_text_subtitle", "xsub"])
+
 
 def extract_subs(lib_path: str, languages: list, sub_format='srt', force: bool = False, force_extras: bool = False,
-                 force_undefined: bool = False) -> int:
+                 force_undefined: bool = False, n_procs: int = 4, exclude: list = None) -> int:
     """ Extracts subtitles from video files recursively starting from the specified directory
     :param lib_path: Base directory from which subtitles will be extracted recursively
     :param languages: list of iso language codes representing languages that should be extracted
@@ -32,6 +52,9 @@ def extract_subs(lib_path: str, languages: list, sub_format='srt', force: bool =
     :param force: If True, will overwrite existing subtitle files
     :param force_extras: If True, subtitles of the same language without differentiating tags are extracted as "extra"
     :param force_undefined: If True, subtitles with undefined languages are extracted as "und"
+    :param n_procs: Number of ffmpeg extraction processes to run concurrently. Up to four times as many ffprobe
+                    processes are run to scan the files.
+    :param exclude: List of glob patterns of directory names that should not be scanned
     :return: 0 if the process ran successfully
     """
 
@@ -43,6 +66,9 @@ def extract_subs(lib_path: str, languages: list, sub_format='srt', force: bool =
     if sub_format[1:] not in supported_sub_formats:
         print("Error - Subtitle format is not among the valid formats:" + str(supported_sub_formats))
         return 1
+    if n_procs < 1:
+        n_procs = 4
+        print("n_procs should be >= 1, value reset to default {}".format(n_procs))
 
     for i in range(len(languages)):
         try:
@@ -50,61 +76,69 @@ def extract_subs(lib_path: str, languages: list, sub_format='srt', force: bool =
         except langcodes.tag_parser.LanguageTagError:
             print('Language code "{}" was not recognised. Use BCP 47 compliant codes.'.format(languages[i]))
             return 1
+    # Interned like the stream language tags returned by get_language_tag, so lookups compare by identity
+    language_set = frozenset(sys.intern(language) for language in languages)
 
-    # Find supported video files
+    # Find supported video files and probe them concurrently while scanning, as each ffprobe process mostly waits
+    # on the disk. Extraction of the subs of a file starts as soon as it has been probed, with several ffmpeg
+    # processes running at once.
     msg = "Scanning {} video files for subtitles to extract"
+    counts = {'dirs': 0}
     video_files = []
-    dir_count = 1  # Start at 1 for the base directory
     vid_count = 0
     ffprobe_errors = []
-    for root, dirs, files in os.walk(lib_path, topdown=True):
-        dirs[:] = [d for d in dirs if not d.endswith(".trickplay")]
-        print_progress(msg, vid_count)
-        for file in files:
-            if _is_supported(file):
-                vid_count += 1
-                filepath = os.path.join(root, file)
-                try:
-                    extractables = _get_extractable_subs(filepath, languages, sub_format, force, force_extras, force_undefined)
-                    if extractables:
-                        video_files += [(filepath, extractables)]
-                except Exception as e:
-                    ffprobe_errors += [file + " " + str(e)]
-        dir_count += len(dirs)
-    print_progress(msg, vid_count, final=True)
-    msg = "{} files needing subs extraction found among {} video files in {} directories"
-    print_progress(msg, len(video_files), vid_count, dir_count, final=True)
-
-    # Extract the subs
-    errors = []
-    to_review = []
-    for file in video_files:
-        base_file = os.path.splitext(file[0])[0]
-        file_name = os.path.basename(file[0])
-        ffmpeg = FFmpeg().option("y").input(file[0])
-        msg = "Extracting subs from: {} "
-        for sub in file[1]:
-            output_file = base_file + sub[1]
-            ffmpeg = ffmpeg.output(output_file, map=['0:{}'.format(sub[0])])
-            if sub[2]:
-                to_review +=[output_file]
-
-        @ffmpeg.on("progress")
-        def on_progress(progress: Progress):
-            on_progress.count += 1
-            if not on_progress.count % 5:
-                print_progress(msg, file_name)
-        on_progress.count = 0
-
-        @ffmpeg.on("completed")
-        def on_completed():
-            print_progress(msg, file_name, final=True)
+    extractions = []
+    queued = set()  # Normcased paths of the subs queued for extraction, only used from this thread
+    with ThreadPoolExecutor(max_workers=min(IO_WORKERS, n_procs * 4)) as probe_executor, \
+            ThreadPoolExecutor(max_workers=n_procs) as extract_executor:
+        def handle_probe(filepath, probe):
+            nonlocal vid_count
+            vid_count += 1
+            try:
+                extractables = probe.result()
+                # Files were probed against the directory listing taken during the scan, so a sub already queued
+                # for another video with the same base name (e.g. movie.mkv and movie.mp4) is not seen as existing.
+                # Skip it, as it would otherwise be written by two ffmpeg processes at once.
+                base_file = os.path.normcase(os.path.splitext(filepath)[0])
+                extractables = [sub for sub in extractables if base_file + os.path.normcase(sub[1]) not in queued]
+                queued.update(base_file + os.path.normcase(sub[1]) for sub in extractables)
+                if extractables:
+                    video_files.append((filepath, extractables))
+                    extractions.append(extract_executor.submit(_extract_file, filepath, extractables, sub_format))
+            except Exception as e:
+                ffprobe_errors.append(os.path.basename(filepath) + " " + str(e))
 
-        try:
-            ffmpeg.execute()
-        except Exception as e:
-            errors += [file_name + " " + str(e)]
-            print_progress(errors[-1], final=True)
+        # Probes are handled in scan order, the ones already done are handled while the library is still being
+        # scanned so extractions can start early
+        probes = collections.deque()
+        for filepath, siblings in _walk_videos(lib_path, counts, exclude or ()):
+            probes.append((filepath, probe_executor.submit(_get_extractable_subs, filepath, language_set, sub_format,
+                                                           force, force_extras, force_undefined, siblings)))
+            while probes and probes[0][1].done():
+                handle_probe(*probes.popleft())
+            with _print_lock:
+                print_progress(msg, vid_count)
+        while probes:
+            handle_probe(*probes.popleft())
+            with _print_lock:
+                print_progress(msg, vid_count)
+        with _print_lock:
+            print_progress(msg, vid_count, final=True)
+            msg = "{} files needing subs extraction found among {} video files in {} directories"
+            print_progress(msg, len(video_files), vid_count, counts['dirs'], final=True)
+
+        # Wait for the extractions
+        errors = []
+        to_review = []
+        for (filepath, extractables), future in zip(video_files, extractions):
+            base_file = os.path.splitext(filepath)[0]
+            to_review += [base_file + sub[1] for sub in extractables if sub[2]]
+            try:
+                future.result()
+            except Exception as e:
+                errors += [os.path.basename(filepath) + " " + str(e)]
+                with _print_lock:
+                    print_progress(errors[-1], final=True)
 
     print_progress("Subtitle extraction completed", final=True)
 
@@ -121,42 +155,79 @@ def extract_subs(lib_path: str, languages: list, sub_format='srt', force: bool =
     return 0
 
 
-def _get_extractable_subs(file: str, languages: list, sub_format: str, force: bool, force_extras: bool, force_undefined: bool) -> list:
+def _print_extract_progress(file_name: str, progress: Progress = None, final: bool = False):
+    """ Prints the extraction progress of a file, from any thread. print_progress limits the actual output rate. """
+    with _print_lock:
+        print_progress("Extracting subs from: {} ", file_name, final=final)
+
+
+def _extract_file(file: str, extractables: list, sub_format: str):
+    """ Extracts subtitle streams from a video file with ffmpeg
+    :param file: Path to the video file
+    :param extractables: List of extractable subs as returned by _get_extractable_subs
+    :param sub_format: file extension format of the extracted sub files
+    :raises Exception: If ffmpeg fails
+    """
+    base_file = os.path.splitext(file)[0]
+    file_name = os.path.basename(file)
+    ffmpeg = FFmpeg().option("y").input(file)
+    target_codec = _SUB_FORMAT_CODECS.get(sub_format)
+    for sub in extractables:
+        options = {"map": ['0:{}'.format(sub[0])], "map_metadata": -1}
+        if sub[3] == target_codec:
+            options["c:s"] = "copy"
+        ffmpeg = ffmpeg.output(base_file + sub[1], options)
+
+    ffmpeg.on("progress", functools.partial(_print_extract_progress, file_name))
+    ffmpeg.on("completed", functools.partial(_print_extract_progress, file_name, final=True))
+    ffmpeg.execute()
+
+
+def _get_extractable_subs(file: str, languages: list, sub_format: str, force: bool, force_extras: bool, force_undefined: bool,
+                          siblings: frozenset = None) -> list:
     """ Check for subtitles matching the desired languages in the video file and if they have already been extracted
     :param file: Path to the video file
-    :param languages: list of iso language codes that should be extracted
+    :param languages: Set or list of iso language codes that should be extracted
     :param sub_format: file extension format for the extracted sub file
     :param force: If True, will overwrite existing subtitle files
     :param force_extras: If True, subtitles of the same language without differentiating tags are extracted as "extra"
     :param force_undefined: If True, subtitles with undefined languages are extracted as "und"
-    :return: List of tuples [(stream_index, extension, user_review_needed)] representing extractable subs streams,
-            the extension to use when writing the sub file and if user review is needed for special cases
+    :param siblings: Optional set of the normcased names of the files in the video's directory, used instead of
+                     checking the file system for existing subtitle files
+    :return: List of tuples [(stream_index, extension, user_review_needed, codec_name)] representing extractable subs
+            streams, the extension to use when writing the sub file, if user review is needed for special cases
+            and the codec of the stream
     """
     base_file = os.path.splitext(file)[0]
-    ffprobe = FFmpeg(executable="ffprobe").input(file, print_format="json", show_streams=None)
-    meta = json.loads(ffprobe.execute())
+    base_name = os.path.normcase(os.path.basename(base_file))
+    # Only the subtitle streams and the fields used below are requested, which keeps the output small.
+    # ffprobe is run directly as only its output is needed, without the event handling of the FFmpeg wrapper
+    ffprobe = subprocess.run(["ffprobe", "-v", "error", "-print_format", "json", "-select_streams", "s",
+                              "-show_entries", _FFPROBE_ENTRIES, "-i", file], capture_output=True)
+    if ffprobe.returncode:
+        error = ffprobe.stderr.decode(errors="replace").strip()
+        raise RuntimeError(error.splitlines()[-1] if error else "ffprobe exited with code {}".format(ffprobe.returncode))
+    meta = json_loads(ffprobe.stdout)
     extractables = []
     extensions = []
-    for stream_index, stream in enumerate(meta['streams']):
-        if (stream['codec_type'].lower() == "subtitle"
-                and 'dvd' not in stream['codec_name'].lower())\
-                and 'hdvm' not in stream['codec_name'].lower()\
-                and 'pgs' not in stream['codec_name'].lower():
+    for stream in meta.get('streams', []):
+        if stream['codec_type'].lower() != "subtitle":
+            continue
+        stream_index = stream['index']
+        tags = stream.get('tags', {})
+        codec_name = stream['codec_name'].lower()
+        if codec_name not in _EXCLUDED_SUB_CODECS:
 
             lang_code = "und"  # Standard code for undefined language
-            if 'language' in stream['tags']:
-                try:
-                    if langcodes.Language.get(stream['tags']['language']).is_valid():
-                        lang_code = langcodes.standardize_tag(stream['tags']['language'])
-                except langcodes.tag_parser.LanguageTagError:
-                    pass
+            if 'language' in tags:
+                lang_code = get_language_tag(tags['language']) or lang_code
 
             user_review_needed = True if lang_code == "und" else False
 
             if (force_undefined and lang_code == "und") or lang_code in languages:
                 extension = "." + lang_code
-                if 'title' in stream['tags']:
-                    stream_title = stream['tags']['title'].lower()
+                if 'title' in tags:
+                    stream_title = tags['title'].lower()
                     if "sdh" in stream_title:
                         extension += '.sdh'
                     elif "cc" in stream_title:
@@ -173,8 +244,12 @@ def _get_extractable_subs(file: str, languages: list, sub_format: str, force: bo
                     user_review_needed = True
 
                 if extension not in extensions:
-                    if force or not os.path.exists(base_file + extension):
-                        extractables += [(stream_index, extension, user_review_needed)]
+                    if siblings is not None:
+                        exists = base_name + os.path.normcase(extension) in siblings
+                    else:
+                        exists = os.path.exists(base_file + extension)
+                    if force or not exists:
+                        extractables += [(stream_index, extension, user_review_needed, codec_name)]
                         extensions += [extension]
 
     return extractables
@@ -182,7 +257,33 @@ def _get_extractable_subs(file: str, languages: list, sub_format: str, force: bo
 
 def _is_supported(file: str):
     """ Check if the file is of a supported format for subtitle extraction """
-    return (file.split(".")[-1]).lower() in supported_video_formats
+    return file.rpartition(".")[2].lower() in _SUPPORTED_VIDEO_FORMATS_SET
+
+
+def _walk_videos(lib_path: str, counts: dict, exclude=()):
+    """ Yields a (path, siblings) tuple for each supported video file found recursively from lib_path, skipping
+        trickplay, hidden and NAS system directories. siblings is a frozenset of the normcased names of all entries
+        in the file's directory.
+    :param counts: Dictionary in which the number of scanned directories ('dirs') is added
+    :param exclude: Glob patterns of directory names to skip
+    """
+    dirs = [lib_path]
+    while dirs:
+        counts['dirs'] += 1
+        try:
+            entries = list(os.scandir(dirs.pop()))
+        except OSError:
+            continue
+        siblings = None
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                # Pruned directories are never listed
+                if not (is_skipped_dir(entry.name) or any(fnmatch.fnmatch(entry.name, p) for p in exclude)):
+                    dirs.append(entry.path)
+            elif _is_supported(entry.name) and entry.is_file():
+                if siblings is None:
+                    siblings = frozenset(os.path.normcase(e.name) for e in entries)
+                yield entry.path, siblings
 
 
 if __name__ == '__main__':
@@ -198,5 +299,11 @@ if __name__ == '__main__':
                         help='Subtitles of the same language without differentiating tags are extracted as "extra"')
     parser.add_argument('-fu', '--force-undefined', action='store_true',
                         help='Subtitles with undefined languages are extracted as "und"')
+    parser.add_argument('-j', '--jobs', '-n', '--n_procs', dest='n_procs', metavar='JOBS', type=int,
+                        default=4,
+                        help='Number of extraction processes to run concurrently, up to four times as many files are '
+                             'probed at once. Lower it for libraries on hard drives.')
+    parser.add_argument('-e', '--exclude', type=str, nargs='+',
+                        help='Glob patterns of directory names that should not be scanned, e.g. "Extras" "Featurettes"')
     args = parser.parse_args()
     sys.exit(extract_subs(**vars(args)))
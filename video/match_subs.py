@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 import argparse
+import collections
+import errno
+import functools
+import heapq
 import langcodes
 import os
 import re
+import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # Allow relative import from shared folder as per PEP 366
 if __name__ == "__main__" and __package__ is None:
@@ -11,10 +17,23 @@ if __name__ == "__main__" and __package__ is None:
     sys.path.insert(1, parent_dir)
     __package__ = "media-library-helper"
 
-from shared.utils import print_progress
-from shared.vid_utils import (get_sub_tags_from_file_name, get_supported_video_extensions,
-                              get_supported_sub_extensions, get_vids_extra_tags)
-from fs.find_empty_dirs import find_empty_dirs
+from shared.utils import IO_WORKERS, print_progress
+from shared.vid_utils import (find_language_tag, get_language_tag, get_sub_tags_from_file_name,
+                              get_supported_video_extensions, get_supported_sub_extensions, get_vids_extra_tags,
+                              is_skipped_dir)
+from fs.find_empty_dirs import is_empty_dir
+
+# The getters return frozensets and a tuple, fetched once here
+_SUB_EXTENSIONS = get_supported_sub_extensions()
+_VIDEO_EXTENSIONS = get_supported_video_extensions()
+# Dotted extensions, for quick filtering with str.endswith()
+_SUB_SUFFIXES = tuple("." + ext for ext in _SUB_EXTENSIONS)
+_VIDEO_SUFFIXES = tuple("." + ext for ext in _VIDEO_EXTENSIONS)
+_VIDS_EXTRA_TAGS = get_vids_extra_tags()
+# Season and episode markers, e.g. S01E02 or s01.e02
+_SEASON_EPISODE_RE = re.compile(r'([sS][0-9]{2})[.\-_]?([eE][0-9]{2})')
+# Common naming of extracted subs, e.g. 2_English
+_EXTRACTED_SUB_RE = re.compile('[0-9]*_[a-zA-Z]*')
 
 
 def match_subs(lib_path: str, supported_languages=[], default_language='', apply_changes=False, remove_empty=False,
@@ -34,7 +53,7 @@ def match_subs(lib_path: str, supported_languages=[], default_language='', apply
     :param default_language: If a BCP-47 language code is specified, it will be used when the language of a subtitle
                              file cannot be determined
     :param apply_changes: If True, files will be moved/renamed. If False, changes are only printed to the console
-    :param remove_empty: If True and apply_changes is also True, empty directories will be removed
+    :param remove_empty: If True and apply_changes is also True, directories left empty by the changes will be removed
     :param remove_unmatched: If True and apply_changes is also True, removes subtitle files not matched to a video file
     :param remove_missing_language: If True and apply_changes is also True, subtitles with missing or unmatched language
                                     tags will be removed
@@ -71,40 +90,38 @@ def match_subs(lib_path: str, supported_languages=[], default_language='', apply
     errors = []
     missing_lang = []
     ambiguous = []
-    for sub_root, dirs, files in os.walk(lib_path):
-        print_progress(msg, sub_count, len(modified)+ len(ambiguous), len(unmatched), len(missing_lang), len(errors))
-        for file in files:
-            file_path = os.path.join(sub_root, file)
-            file_base, file_ext = os.path.splitext(file)
-            file_ext = file_ext[1:].lower()
-            if file_ext in get_supported_sub_extensions():
-                sub_count += 1
-
-                # Find video files that can be matched to the sub file
-                vid_root = find_vids(sub_root)
-                match = match_vid(sub_root, vid_root, file_base)
-
-                if not match:
-                    unmatched += [file_path]
-                else:
-                    # If a match exists, find the file language and other name tags
-                    tags, ambiguous_sub = get_sub_tags(sub_root, file_base, file, match)
-                    if not tags or (supported_languages and tags[0] not in supported_languages):
-                        missing_lang += [file_path]
-                    else:
-                        # Use the match and tags to determine the target location of the file
-                        move_to = os.path.join(vid_root, ".".join([match] + tags + [file_ext]))
-                        if move_to != file_path:
-                            if ambiguous_sub:
-                                ambiguous += [(file_path, move_to)]
-                            else:
-                                modified += [(file_path, move_to)]
+
+    def add_results(results):
+        nonlocal sub_count
+        sub_count += results[0]
+        modified.extend(results[1])
+        ambiguous.extend(results[2])
+        unmatched.extend(results[3])
+        missing_lang.extend(results[4])
+
+    # Folders are scanned once per run, the library is not modified until the walk is done
+    dir_cache = dict()
+    # Folders are matched in threads since the work is mostly waiting on the file system. Results are collected in
+    # walk order so the output is the same as a sequential run.
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+        for sub_root, dirs, files in os.walk(lib_path):
+            dirs[:] = [d for d in dirs if not is_skipped_dir(d)]
+            # Most folders only hold videos, there is nothing to match in those
+            if any(f.lower().endswith(_SUB_SUFFIXES) for f in files):
+                pending.append(executor.submit(_match_dir, sub_root, files, supported_languages, dir_cache))
+            while pending and pending[0].done():
+                add_results(pending.popleft().result())
+            print_progress(msg, sub_count, len(modified) + len(ambiguous), len(unmatched), len(missing_lang),
+                           len(errors))
+        while pending:
+            add_results(pending.popleft().result())
 
     # Apply changes and prints out the results
     print_progress(msg, sub_count, len(modified) + len(ambiguous), len(unmatched), len(missing_lang), len(errors), final=True)
 
-    [print("Planned change : " + x[0] + "  ----->>>  " + x[1]) for x in modified]
-    [print("Planned change (ambiguous) : " + x[0] + "  ----->>>  " + x[1]) for x in ambiguous]
+    _print_lines("Planned change : " + x[0] + "  ----->>>  " + x[1] for x in modified)
+    _print_lines("Planned change (ambiguous) : " + x[0] + "  ----->>>  " + x[1] for x in ambiguous)
     if apply_changes:
         print("\nApplying changes...")
         move_files(modified, errors)
@@ -112,14 +129,14 @@ def match_subs(lib_path: str, supported_languages=[], default_language='', apply
 
     if unmatched:
         print()
-        [print("Unmatched: " + x) for x in unmatched]
+        _print_lines("Unmatched: " + x for x in unmatched)
         if apply_changes and remove_unmatched:
             remove_files(unmatched, errors)
             print("Unmatched files have been removed")
 
     if missing_lang:
         print()
-        [print("Missing or unmatched language tag: " + x) for x in missing_lang]
+        _print_lines("Missing or unmatched language tag: " + x for x in missing_lang)
         if apply_changes and remove_missing_language:
             remove_files(missing_lang, errors)
             print("Files with missing or unmatched language tags have been removed")
@@ -129,15 +146,85 @@ def match_subs(lib_path: str, supported_languages=[], default_language='', apply
         print_progress(msg, sub_count, len(modified) + len(ambiguous), len(unmatched), len(missing_lang), len(errors), final=True)
 
     if apply_changes and remove_empty:
+        # Only the folders files were moved or removed from can have been emptied, no need to walk the library again
+        changed_files = [x[0] for x in modified + ambiguous]
+        if remove_unmatched:
+            changed_files += unmatched
+        if remove_missing_language:
+            changed_files += missing_lang
         print()
-        find_empty_dirs(lib_path, ignore_hidden=False, ignore_size=0, remove='yes')
+        remove_emptied_dirs(lib_path, {os.path.dirname(f) for f in changed_files}, errors)
 
     print()
-    [print(x) for x in errors]
+    _print_lines(errors)
 
     return 0
 
 
+def _print_lines(lines):
+    """ Prints lines with a single write instead of one print per line, nothing is printed if there are no lines """
+    text = "\n".join(lines)
+    if text:
+        print(text)
+
+
+def _match_dir(sub_root, files, supported_languages, cache=None):
+    """ Matches the subtitle files of a single directory to video files
+    :param sub_root: The directory containing the files
+    :param files: Names of the files in the directory, as returned by os.walk()
+    :param supported_languages: List of standardized language tags to process, all languages are processed if empty
+    :param cache: Optional dictionary in which directory scans are kept for the duration of a run
+    :return: A tuple with the number of subtitles found, and the lists of modified, ambiguous, unmatched and
+             missing language subtitles
+    """
+    sub_count = 0
+    modified = []
+    ambiguous = []
+    unmatched = []
+    missing_lang = []
+    for file in files:
+        # A single suffix test skips most files before the file name is split
+        if not file.lower().endswith(_SUB_SUFFIXES):
+            continue
+        file_path = os.path.join(sub_root, file)
+        file_base, file_ext = os.path.splitext(file)
+        file_ext = file_ext[1:].lower()
+        if file_ext in _SUB_EXTENSIONS:
+            sub_count += 1
+
+            # Find video files that can be matched to the sub file
+            vid_root = find_vids(sub_root, cache)
+            match = match_vid(sub_root, vid_root, file_base, cache)
+
+            if not match:
+                unmatched += [file_path]
+            else:
+                # If a match exists, find the file language and other name tags
+                tags, ambiguous_sub = get_sub_tags(sub_root, file_base, file, match, cache)
+                if not tags or (supported_languages and tags[0] not in supported_languages):
+                    missing_lang += [file_path]
+                else:
+                    # Use the match and tags to determine the target location of the file
+                    move_to = os.path.join(vid_root, ".".join([match] + tags + [file_ext]))
+                    if move_to != file_path:
+                        if ambiguous_sub:
+                            ambiguous += [(file_path, move_to)]
+                        else:
+                            modified += [(file_path, move_to)]
+
+    return sub_count, modified, ambiguous, unmatched, missing_lang
+
+
+def _cached(cache, func, path):
+    """ Returns func(path), reusing the result kept in the cache dictionary if one is given """
+    if cache is None:
+        return func(path)
+    key = (func, path)
+    if key not in cache:
+        cache[key] = func(path)
+    return cache[key]
+
+
 def contains_vids(path):
     """ Scans a directory for video files and returns True if any is found """
     for f in os.scandir(path):
@@ -146,10 +233,12 @@ def contains_vids(path):
     return False
 
 
-def find_vids(root):
-    """ Finds the closest folder with videos that are not extras, going one or two level above the root folder """
+def find_vids(root, cache=None):
+    """ Finds the closest folder with videos that are not extras, going one or two level above the root folder.
+        Directory scans are kept in the optional cache dictionary.
+    """
 
-    if contains_vids(root):
+    if _cached(cache, contains_vids, root):
         return root
     else:
         parent = os.path.dirname(root)
@@ -157,21 +246,22 @@ def find_vids(root):
         if parent.lower().endswith("subs"):
             parent = os.path.dirname(parent)
 
-        if contains_vids(parent):
+        if _cached(cache, contains_vids, parent):
             return parent
 
     return ''
 
 
-def get_sub_tags(sub_root, file_base, file, match):
-    """ Returns a list of tags that should be appended to the sub file name, and the ambiguous marker i"""
+def get_sub_tags(sub_root, file_base, file, match, cache=None):
+    """ Returns a list of tags that should be appended to the sub file name, and the ambiguous marker i
+        Directory scans are kept in the optional cache dictionary.
+    """
 
     # Remove the video file name from the sub file name to prevent parts from being seen as tags
     if file.startswith(match):
         subs_specific_name = file[len(match):]
-        split_name = subs_specific_name.split(".")
-        # Is it more than an extension? Is the first part not empty or longer than 2 (in case it starts with a ".")
-        if subs_specific_name.split(".")[0] or len(split_name) > 2:
+        # Is it more than an extension? Is the first part not empty, or are there more parts if it starts with a "."
+        if not subs_specific_name.startswith(".") or subs_specific_name.count(".") > 1:
             tags = get_sub_tags_from_file_name(subs_specific_name)
         else:
             tags = []
@@ -180,30 +270,21 @@ def get_sub_tags(sub_root, file_base, file, match):
 
     ambiguous = False
     # Check for an alternate common formatting for extracted subs
-    if not tags and re.fullmatch('[0-9]*_[a-zA-Z]*', file_base):
+    if not tags and _EXTRACTED_SUB_RE.fullmatch(file_base):
         lang = file_base.split("_")[1]
-        try:
-            if langcodes.Language.get(lang).is_valid():
-                tags = [langcodes.standardize_tag(lang)]
-        except langcodes.tag_parser.LanguageTagError:
-            pass
-
-        # Check for a full language name
-        if not tags:
-            try:
-                tags = [langcodes.find(lang).to_tag()]
-            except LookupError:
-                pass
+        # Check for a language code, then for a full language name
+        lang_tag = get_language_tag(lang) or find_language_tag(lang)
+        if lang_tag:
+            tags = [lang_tag]
 
         #  There may be multiples files with the same languages in this case, try to determine what they are
         if tags:
-            subs = [f for f in os.listdir(sub_root)
-                    if os.path.splitext(f)[1][1:].lower() in get_supported_sub_extensions()
-                    and re.match('[0-9]*_{}*'.format(lang), f)]
+            lang_re = _get_extracted_sub_lang_re(lang)
+            entries = [e for e in _cached(cache, get_subs_and_sizes, sub_root) if lang_re.match(e[1])]
 
-            if len(subs) > 1:
-                sizes = [os.path.getsize(os.path.join(sub_root, f)) for f in subs]
-                files_and_sizes = sorted(list(zip(sizes, subs)), key=lambda x: x[0])
+            if len(entries) > 1:
+                sizes = [e[0] for e in entries]
+                files_and_sizes = sorted(entries, key=lambda x: x[0])
                 for i in range(len(files_and_sizes)):
                     if file_base in files_and_sizes[i][1]:
                         current_sub_index = i
@@ -236,6 +317,23 @@ def get_sub_tags(sub_root, file_base, file, match):
     return tags, ambiguous
 
 
+@functools.lru_cache(maxsize=256)
+def _get_extracted_sub_lang_re(lang):
+    """ Returns a compiled regex matching extracted subs named with a language, e.g. 2_English """
+    return re.compile('[0-9]*_{}*'.format(lang))
+
+
+def get_subs_and_sizes(path):
+    """ Get the sizes and names of the supported subtitle files in a directory
+    :param path: The directory to scan
+    :return: A tuple of (size, file name) tuples
+    """
+    with os.scandir(path) as it:
+        return tuple((f.stat().st_size, f.name) for f in it
+                     if f.name.lower().endswith(_SUB_SUFFIXES)
+                     and os.path.splitext(f.name)[1][1:].lower() in _SUB_EXTENSIONS and f.is_file())
+
+
 def get_vids(path):
     """ Get a lit of supported video files without file extensions"""
     return [os.path.splitext(f.name)[0] for f in os.scandir(path) if is_vid(f)]
@@ -246,10 +344,9 @@ def is_vid(entry):
     :param entry: An os.DirEntry, e.g. returned by os.scandir()
     :return: True if the file is a supported video, False if not
     """
-    if entry.is_file():
+    if entry.name.lower().endswith(_VIDEO_SUFFIXES) and entry.is_file():
         base, ext = os.path.splitext(entry.name)
-        return (ext[1:].lower() in get_supported_video_extensions()
-                and not any(base.endswith(x) for x in get_vids_extra_tags()))
+        return ext[1:].lower() in _VIDEO_EXTENSIONS and not base.endswith(_VIDS_EXTRA_TAGS)
     else:
         return False
 
@@ -264,11 +361,13 @@ def list_item_in_str(str_list, string):
     return ''
 
 
-def match_vid(sub_root, vid_root, file_base):
-    """ Tries to match a subfile to a video file, returns the matching file name without extension if found"""
+def match_vid(sub_root, vid_root, file_base, cache=None):
+    """ Tries to match a subfile to a video file, returns the matching file name without extension if found.
+        Directory scans are kept in the optional cache dictionary.
+    """
     match = ''
     if vid_root:
-        vids = get_vids(vid_root)
+        vids = _cached(cache, get_vids, vid_root)
         if vids:
 
             # Check for a perfect match
@@ -287,11 +386,13 @@ def match_vid(sub_root, vid_root, file_base):
 
                     # If there is still no match, try to match with season/episode markers
                     if not match:
-                        lookup = re.search('([sS][0-9]{2})[.-_]?([eE][0-9]{2})', file_base + sub_dir)
+                        lookup = _SEASON_EPISODE_RE.search(file_base + sub_dir)
                         if lookup:
-                            lookup = '{}[.-_]?{}'.format(lookup.group(1), lookup.group(2))
+                            season, episode = lookup.groups()
+                            # The separator is optional and one of . - _ so a few substring tests cover all cases
+                            markers = [season + sep + episode for sep in ('', '.', '-', '_')]
                             for v in vids:
-                                if re.search(lookup, v):
+                                if any(m in v for m in markers):
                                     match = v
                                     break
 
@@ -302,21 +403,72 @@ def move_files(file_list, error_list):
     """ Attempts to replace the files in the file_list where each item is a tuple (source, dest) """
     for source, dest in file_list:
         try:
-            if os.path.exists(dest):
+            if os.path.lexists(dest):
                 error_list += ["Error: {} ==> New destination already exists: {}".format(source, dest)]
-            else:
-                os.replace(source, dest)
+                continue
+            try:
+                os.rename(source, dest)
+            except OSError as e:
+                # Files can only be renamed on the same device, otherwise they are copied
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(source, dest)
         except Exception as e:
             error_list += [str(e)]
 
 
 def remove_files(file_list, error_list):
-    """ Attempts to remove the files in the list """
-    for file in file_list:
+    """ Attempts to remove the files in the list, in threads since each removal mostly waits on the file system """
+    with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+        error_list += [e for e in executor.map(_remove_file, file_list) if e]
+
+
+def remove_emptied_dirs(lib_path, dirs, error_list):
+    """ Removes the directories in dirs which are empty, then their parents if they are left empty, up to lib_path.
+        A directory is considered empty if it contains no or only empty directories and symbolic links, as with
+        find_empty_dirs.
+    :param lib_path: Base directory, which is never removed
+    :param dirs: Set of directories to check
+    :param error_list: List to which errors are added
+    """
+    # Absolute paths, so the library root and its subdirectories compare the same way however lib_path was given
+    lib_path = os.path.abspath(lib_path)
+    seen = {os.path.abspath(d) for d in dirs}
+    # Deepest directories first, so parents are checked after their subdirectories
+    heap = [(-d.count(os.sep), d) for d in seen]
+    heapq.heapify(heap)
+    removed = []
+    while heap:
+        d = heapq.heappop(heap)[1]
+        if d == lib_path or os.path.commonpath((lib_path, d)) != lib_path or not is_empty_dir(d):
+            continue
         try:
-            os.remove(file)
+            shutil.rmtree(d)
+            removed += [d]
         except Exception as e:
             error_list += [str(e)]
+            continue
+
+        parent = os.path.dirname(d)
+        if parent not in seen:
+            seen.add(parent)
+            heapq.heappush(heap, (-parent.count(os.sep), parent))
+
+    if removed:
+        _print_lines(sorted(removed))
+        print()
+        print("The above directories were empty and have been removed")
+    else:
+        print("No empty directories found")
+
+
+def _remove_file(file):
+    """ Removes a file and returns an error message if it failed, or an empty string """
+    try:
+        os.remove(file)
+    except Exception as e:
+        return str(e)
+    return ''
 
 
 if __name__ == '__main__':
@@ -325,7 +477,7 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--languages', type=str, nargs='+', default=[], help='Language codes of subtitle files to process')
     parser.add_argument('-dl', '--default-language', type=str, default='', help='Default language tag to apply to files without language tags')
     parser.add_argument('-a', '--apply', action='store_true', help='Apply changes (move and rename files if necessary)')
-    parser.add_argument('-re', '--remove-empty', action='store_true', help='Remove empty directories')
+    parser.add_argument('-re', '--remove-empty', action='store_true', help='Remove directories left empty by the changes')
     parser.add_argument('-ru', '--remove-unmatched', action='store_true', help='Remove subtitle files not matched to a video file')
     parser.add_argument('-rm', '--remove-missing', action='store_true', help='Remove subtitle files with missing or unmatched language tags')
     args = parser.parse_args()